@@ -19,11 +19,13 @@ def create_embedding_results_directory(model_name):
         os.makedirs(embedding_results_dir)
     return embedding_results_dir
 
-def load_and_preprocess_dataset(dataset_name):
+def load_and_preprocess_dataset(dataset_name, structural_features=False):
     dataset_dir = os.path.join('datasets', dataset_name)
     dataset = TUDataset(root=dataset_dir, name=dataset_name)
     num_classes = dataset.num_classes
     num_features = dataset.num_features
+    if structural_features:
+        dataset = precompute_structural_features(dataset)
     return dataset, num_features, num_classes
 
 def create_data_loaders(dataset, batch_size=64):
@@ -111,7 +113,7 @@ def main():
     for model_name in model_names:
         for dataset_name in dataset_names:
             embedding_results_dir = create_embedding_results_directory(model_name)
-            dataset, num_features, num_classes = load_and_preprocess_dataset(dataset_name)
+            dataset, num_features, num_classes = load_and_preprocess_dataset(dataset_name, structural_features=model_name in STRUCTURAL_FEATURE_MODELS)
             test_loader = create_data_loaders(dataset)
 
             model_results_dir = os.path.join('results', model_name)
@@ -19,7 +19,7 @@ def main():
         model_results_dir = create_model_results_directory(model_name)
 
         for dataset_name in dataset_list:
-            dataset, num_features, num_classes = preprocess_dataset(dataset_name)
+            dataset, num_features, num_classes = preprocess_dataset(dataset_name, structural_features=model_name in STRUCTURAL_FEATURE_MODELS)
             train_dataset, test_dataset = split_dataset(dataset)
 
             batch_size = 64
@@ -1,107 +1,274 @@
 import os
+import functools
+import collections
+import concurrent.futures
 import torch
-import networkx as nx
 import numpy as np
-import scipy.linalg
-import multiprocessing
+import scipy.sparse.linalg
+import numba
+from numba import njit, prange
 import scipy.stats as stats
 import pandas as pd
+from torch_geometric.utils import subgraph
 
-# Convert edge_index to NetworkX graph
-def edge_index_to_nx_graph(edge_index, num_nodes):
-    edge_list = edge_index.t().tolist()
-    G = nx.Graph()
-    G.add_nodes_from(range(num_nodes))
-    G.add_edges_from(edge_list)
-    return G
-
-#Calculatiing normalized Laplacian of graph
-def normalized_laplacian(graph: nx.Graph) -> torch.Tensor:
-    """Computes the symmetric normalized Laplacian matrix."""
-    # Convert to dense matrix and float type and also make sure graph has Laplacian
-    adjacency_matrix = nx.adjacency_matrix(graph).toarray().astype(float) + 1e-9
-    num_nodes = adjacency_matrix.shape[0]
-
-    # Calculate the degree matrix
-    d = torch.sum(torch.tensor(adjacency_matrix), dim=1)
-    Dinv_sqrt = torch.diag(1 / torch.sqrt(d)) + 1e-9
-
-    # Compute the normalized Laplacian matrix
-    Ln = torch.eye(num_nodes, device=Dinv_sqrt.device, dtype=torch.double) - torch.mm(torch.mm(Dinv_sqrt, torch.tensor(adjacency_matrix, dtype=torch.double)), Dinv_sqrt)
-    Ln = 0.5 * (Ln + Ln.T)
+#Calculatiing normalized Laplacian of every graph in a batch of equally sized graphs
+def normalized_laplacian(adjacency: torch.Tensor) -> torch.Tensor:
+    """Computes the symmetric normalized Laplacian matrices of a (B, n, n) adjacency batch."""
+    # Convert to float type and also make sure every node has Laplacian
+    adjacency = adjacency.double() + 1e-9
+
+    # Calculate the inverse square root degrees, the 1e-9 guard keeps them finite for isolated nodes
+    dinv_sqrt = torch.rsqrt(torch.sum(adjacency, dim=-1))
+
+    # Compute the normalized Laplacian by scaling rows and columns instead of multiplying by diagonal matrices
+    Ln = -adjacency * dinv_sqrt.unsqueeze(-1) * dinv_sqrt.unsqueeze(-2)
+    Ln.diagonal(dim1=-2, dim2=-1).add_(1.0)
 
     return Ln
 
-#Approximataion of eigenvectors of matrix
+# Shift-invert Lanczos for the k smallest eigenvectors of one graph's normalized Laplacian, from its scipy CSR adjacency
+def smallest_eigenvectors(adjacency, k, shift=-1e-6):
+    num_nodes = adjacency.shape[0]
+    # normalized_laplacian adds 1e-9 to every adjacency entry, i.e. the rank-one term 1e-9 * 1 1^T, so the same
+    # Laplacian is the sparse S = I - D^-1/2 A D^-1/2 minus 1e-9 * u u^T with u = D^-1/2 1, and is never densified
+    dinv_sqrt = 1 / np.sqrt(np.asarray(adjacency.sum(axis=1)).ravel() + 1e-9 * num_nodes)
+    identity = scipy.sparse.identity(num_nodes, format='csr')
+    laplacian = identity - scipy.sparse.diags(dinv_sqrt) @ adjacency @ scipy.sparse.diags(dinv_sqrt)
+
+    # The gaps between the smallest eigenvalues can be far below any useful tolerance (a long cycle, or the null
+    # space of a graph with several components). Inverting about a shift just below the spectrum makes exactly
+    # those eigenvalues the best separated. S - shift * I is positive definite, so its sparse LU is stable, and
+    # Sherman-Morrison adds the rank-one guard back to each solve
+    lu = scipy.sparse.linalg.splu((laplacian - shift * identity).tocsc())
+    lu_u = lu.solve(dinv_sqrt)
+    denominator = 1 - 1e-9 * (dinv_sqrt @ lu_u)
+
+    def solve(x):
+        y = lu.solve(np.ravel(x))
+        return y + 1e-9 * lu_u * (dinv_sqrt @ y) / denominator
+
+    def matvec(x):
+        x = np.ravel(x)
+        return laplacian @ x - 1e-9 * dinv_sqrt * (dinv_sqrt @ x)
+
+    shape = (num_nodes, num_nodes)
+    operator = scipy.sparse.linalg.LinearOperator(shape, matvec=matvec, dtype=np.float64)
+    inverse = scipy.sparse.linalg.LinearOperator(shape, matvec=solve, dtype=np.float64)
+    w, v = scipy.sparse.linalg.eigsh(operator, k=k, sigma=shift, which='LM', OPinv=inverse, v0=np.ones(num_nodes))  # Fixed start vector keeps runs reproducible
+    return torch.from_numpy(v[:, np.argsort(w)].astype(np.float32))  # Reorder and narrow in one copy
+
+#Approximataion of eigenvectors of a batch of matrices
 def approximate_matrix(g, k):
-    _, v = scipy.linalg.eigh(g, subset_by_index=[0, min(k - 1, g.shape[0] - 1)])
-    return torch.tensor(np.single(v))
-
-def calculate_centrality(graph, method, result_queue, index):
-    centrality = method(graph)
-    result_queue.put((index, centrality))
-
-def extract_numerical_values(centrality_dict):
-    # Extract numerical values from the centrality dictionary
-    return [value for value in centrality_dict.values()]
-
-def all_centralities(graph):
-    centrality_methods = [
-        (nx.algorithms.centrality.closeness_centrality, "closeness_centrality"),
-        (nx.algorithms.centrality.degree_centrality, "degree_centrality"),
-        (nx.algorithms.centrality.betweenness_centrality, "betweenness_centrality"),
-        (nx.algorithms.centrality.load_centrality, "load_centrality"),
-        (nx.algorithms.centrality.subgraph_centrality, "subgraph_centrality"),
-        (nx.algorithms.centrality.harmonic_centrality, "harmonic_centrality")
-    ]
-    
-    manager = multiprocessing.Manager()
-    result_queue = manager.Queue()
-    processes = []
-    
-    for index, (method, name) in enumerate(centrality_methods):
-        process = multiprocessing.Process(target=calculate_centrality, args=(graph, method, result_queue, index))
-        processes.append(process)
-        process.start()
-    
-    for process in processes:
-        process.join()
-    
-    centralities_dict = {}
-    while not result_queue.empty():
-        index, centrality = result_queue.get()
-        method_name = centrality_methods[index][1]
-        centralities_dict[method_name] = centrality
-    
-    # Extract numerical values and convert them to tensors with dtype=float
-    centralities = [torch.tensor(extract_numerical_values(centralities_dict[method_name]), dtype=torch.float) for (_, method_name) in centrality_methods]
-    
-    return torch.stack(centralities, dim=1)
-
-# Select top-k graph based on scores
-def top_k_pool(scores, edge_index, h, ratio):
+    _, v = torch.linalg.eigh(g)  # Batched, and stays on the device of g
+    v = v[..., :k]
+    if v.shape[-1] < k:
+        v = torch.nn.functional.pad(v, (0, k - v.shape[-1]))  # Graphs smaller than k get zero columns
+    return v.float()
+
+# Convert edge_index to a symmetric, duplicate-free CSR adjacency as (indptr, indices) int32 tensors
+def edge_index_to_csr(edge_index, num_nodes):
+    edge_index = edge_index.cpu()
+    if edge_index.numel() > 0:
+        num_nodes = max(num_nodes, int(edge_index.max()) + 1)
+    src, dst = torch.cat([edge_index, edge_index.flip(0)], dim=1)  # Treat every edge as undirected
+    keys = torch.unique(src * num_nodes + dst)  # Sorted by source, duplicate edges collapse
+    indptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    indptr[1:] = torch.cumsum(torch.bincount(keys // num_nodes, minlength=num_nodes), dim=0)
+    return indptr.int(), (keys % num_nodes).int()
+
+# Wrap the CSR arrays of edge_index in a scipy matrix without copying them
+def csr_adjacency(edge_index, num_nodes):
+    indptr, indices = edge_index_to_csr(edge_index, num_nodes)
+    num_nodes = indptr.numel() - 1
+    return scipy.sparse.csr_matrix((np.ones(indices.numel()), indices.numpy(), indptr.numpy()), shape=(num_nodes, num_nodes))
+
+# Exact diag(exp(A)) from one dense symmetric eigendecomposition of the adjacency, as NetworkX computes it
+def subgraph_centrality(adjacency):
+    w, v = np.linalg.eigh(adjacency.toarray())
+    return (v ** 2) @ np.exp(w)
+
+@njit(parallel=True, cache=True)
+def _fused_bfs_centralities(indptr, indices, num_chunks):
+    """Accumulates unscaled closeness, betweenness, load and harmonic centrality from one BFS per source."""
+    num_nodes = len(indptr) - 1
+    closeness = np.zeros(num_nodes)
+    harmonic = np.zeros(num_nodes)
+    # Sources are split into chunks, each with its own accumulators so threads never share a write
+    betweenness = np.zeros((num_chunks, num_nodes))
+    load = np.zeros((num_chunks, num_nodes))
+
+    for chunk in prange(num_chunks):
+        dist = np.full(num_nodes, -1, dtype=np.int64)
+        sigma = np.zeros(num_nodes)
+        delta = np.zeros(num_nodes)
+        flow = np.ones(num_nodes)
+        S = np.empty(num_nodes, dtype=np.int64)  # BFS queue, later walked backwards as the stack
+
+        for s in range(chunk, num_nodes, num_chunks):
+            dist[s] = 0
+            sigma[s] = 1.0
+            S[0] = s
+            head, tail = 0, 1
+            while head < tail:
+                v = S[head]
+                head += 1
+                for j in range(indptr[v], indptr[v + 1]):
+                    w = indices[j]
+                    if dist[w] < 0:
+                        dist[w] = dist[v] + 1
+                        S[tail] = w
+                        tail += 1
+                    if dist[w] == dist[v] + 1:
+                        sigma[w] += sigma[v]
+
+            total_distance = 0
+            inverse_distance = 0.0
+            for i in range(1, tail):
+                total_distance += dist[S[i]]
+                inverse_distance += 1.0 / dist[S[i]]
+            harmonic[s] = inverse_distance
+            if total_distance > 0:
+                reached = tail - 1
+                closeness[s] = reached / total_distance * reached / (num_nodes - 1)
+
+            # Predecessors of w are its neighbours one level closer, so no predecessor lists are stored.
+            # Brandes dependencies give betweenness, Newman's even split over predecessors gives load
+            for i in range(tail - 1, 0, -1):
+                w = S[i]
+                num_predecessors = 0
+                for j in range(indptr[w], indptr[w + 1]):
+                    if dist[indices[j]] == dist[w] - 1:
+                        num_predecessors += 1
+                coefficient = (1.0 + delta[w]) / sigma[w]
+                share = flow[w] / num_predecessors
+                for j in range(indptr[w], indptr[w + 1]):
+                    v = indices[j]
+                    if dist[v] == dist[w] - 1:
+                        delta[v] += sigma[v] * coefficient
+                        if v != s:
+                            flow[v] += share
+                betweenness[chunk, w] += delta[w]
+                load[chunk, w] += flow[w] - 1.0
+
+            for i in range(tail):
+                v = S[i]
+                dist[v] = -1
+                sigma[v] = 0.0
+                delta[v] = 0.0
+                flow[v] = 1.0
+
+    return closeness, betweenness.sum(axis=0), load.sum(axis=0), harmonic
+
+def all_centralities(adjacency, parallel_min_nodes=500):
+    """Computes the six centralities of a 0/1 scipy CSR adjacency, scaled as in NetworkX."""
+    num_nodes = adjacency.shape[0]
+    if num_nodes < 2:
+        return torch.zeros((num_nodes, 6), dtype=torch.float)
+
+    # Large graphs spread their BFS sources over all numba threads
+    num_chunks = 1 if num_nodes < parallel_min_nodes else numba.get_num_threads()
+    closeness, betweenness, load, harmonic = _fused_bfs_centralities(adjacency.indptr, adjacency.indices, num_chunks)
+
+    if num_nodes > 2:
+        # Every undirected path is counted from both endpoints, as in NetworkX
+        scale = 1.0 / ((num_nodes - 1) * (num_nodes - 2))
+        betweenness *= scale
+        load *= scale
+
+    degree = (np.diff(adjacency.indptr) + adjacency.diagonal()) / (num_nodes - 1)  # Self-loops count twice
+
+    centralities = [closeness, degree, betweenness, load, subgraph_centrality(adjacency), harmonic]
+    return torch.from_numpy(np.stack(centralities, axis=1, dtype=np.float32))  # Shares the stacked buffer, no second copy
+
+# Attach topology-only features once per graph so pooling layers do not recompute them every forward
+def add_structural_features(data, parallel_min_nodes=500):
+    # Build the CSR adjacency once and share it between all features
+    adjacency = csr_adjacency(data.edge_index, data.num_nodes)
+    # Scores only feed a sigmoid and top-k, so bfloat16 storage halves the bytes batched and moved per step
+    data.centralities = all_centralities(adjacency, parallel_min_nodes).to(torch.bfloat16)
+    data.hop3_index = three_hop_index(adjacency)
+    return data
+
+# Compute structural features for every graph of a dataset, one graph per worker task
+def precompute_structural_features(dataset, max_workers=None):
+    if (max_workers or os.cpu_count()) == 1:
+        return add_laplacian_eigenvectors([add_structural_features(data) for data in dataset])
+    # Graphs are already spread over the workers, so each one runs its own BFS on a single thread
+    add_features = functools.partial(add_structural_features, parallel_min_nodes=float('inf'))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return add_laplacian_eigenvectors(list(executor.map(add_features, dataset, chunksize=16)))
+
+# Attach the k smallest Laplacian eigenvectors to every graph, decomposing small graphs of equal size in one batched call
+def add_laplacian_eigenvectors(data_list, k=3, dense_max_nodes=256, max_batch_bytes=2 ** 27):
+    by_size = collections.defaultdict(list)
+    for data in data_list:
+        by_size[data.num_nodes].append(data)  # Equal sizes need no padding
+    for num_nodes, graphs in by_size.items():
+        if num_nodes > dense_max_nodes:
+            # A dense O(n^3) solve is wasted on large graphs when only k eigenvectors are needed
+            for data in graphs:
+                data.leig = smallest_eigenvectors(csr_adjacency(data.edge_index, num_nodes), k).to(torch.bfloat16)
+            continue
+        # Cap each (B, n, n) float64 tensor by bytes, normalized_laplacian keeps two more of the same size alive
+        batch_size = max(1, max_batch_bytes // (8 * max(num_nodes, 1) ** 2))
+        for start in range(0, len(graphs), batch_size):
+            chunk = graphs[start:start + batch_size]
+            # Scatter the edges of the whole chunk into one (B, n, n) tensor, in both directions
+            graph = torch.cat([torch.full((data.edge_index.size(1),), i) for i, data in enumerate(chunk)])
+            src, dst = torch.cat([data.edge_index for data in chunk], dim=1)
+            adjacency = torch.zeros(len(chunk), chunk[0].num_nodes, chunk[0].num_nodes, dtype=torch.double)
+            adjacency[graph, src, dst] = 1
+            adjacency[graph, dst, src] = 1
+            for data, leig in zip(chunk, approximate_matrix(normalized_laplacian(adjacency), k)):
+                data.leig = leig.to(torch.bfloat16)  # Like the centralities, only feeds a score, so half the bytes to batch
+    return data_list
+
+# Nonzero pattern of A^3, i.e. the node pairs joined by a walk of length three
+def three_hop_index(adjacency):
+    reachable = (adjacency @ adjacency @ adjacency).tocoo()
+    return torch.from_numpy(np.stack([reachable.row, reachable.col])).long()
+
+# Select top-k graph based on score logits
+def top_k_pool(weights, edge_index, h, ratio, hop3_index=None):
     num_nodes = h.shape[0]
-    values, idx = torch.topk(scores.squeeze(), max(2, int(ratio * num_nodes)))  # Get top-k values and indices
+    weights = weights.view(-1)
+    idx = torch.topk(weights, max(2, int(ratio * num_nodes)), sorted=False).indices  # Sigmoid is monotone, rank the logits
+    values = torch.sigmoid(weights[idx])  # Scores are only needed for the kept nodes
     new_h = h[idx, :]  # Select top-k nodes
     values = torch.unsqueeze(values, -1)
     new_h = torch.mul(new_h, values)  # Apply weights to nodes
-    g = adjacency_matrix(edge_index, num_nodes=num_nodes)  # Create adjacency matrix
-    un_g = torch.matmul(g.bool().float(), torch.matmul(g.bool().float(), g.bool().float())).bool().float()  # Calculate unnormalized graph
-    un_g = un_g[idx, :][:, idx]  # Select top-k subgraph
+    if hop3_index is not None:
+        # Reuse the A^3 pattern precomputed with the dataset, filtering and relabelling its pairs in one pass
+        sub_index, _ = subgraph(idx, hop3_index, relabel_nodes=True, num_nodes=num_nodes)
+        un_g = torch.sparse_coo_tensor(sub_index, torch.ones(sub_index.size(1), device=h.device), (idx.numel(), idx.numel()), check_invariants=False)  # subgraph relabels into range
+    else:
+        g = adjacency_matrix(edge_index, num_nodes)
+        # Select the top-k rows and columns with a 0/1 selection matrix, CSR has no index_select
+        keep = torch.sparse_csr_tensor(torch.arange(idx.numel() + 1, device=idx.device), idx, torch.ones(idx.numel(), device=h.device), (idx.numel(), num_nodes), check_invariants=False)
+        # Calculate only the top-k rows and columns of A^3, no full N x N product is formed
+        un_g = (keep @ g) @ (g @ (g @ keep.t().to_sparse_csr()))
+        un_g = torch.sparse_csr_tensor(un_g.crow_indices(), un_g.col_indices(), torch.ones_like(un_g.values()), un_g.shape, check_invariants=False)  # Keep reachability only
     g = norm_g(un_g)  # Normalize the graph
     return g, new_h, idx
 
-# Create adjacency matrix from edge_index
-def adjacency_matrix(edge_index, num_nodes=None):
-    if num_nodes is None:
-        num_nodes = edge_index.max().item() + 1
-    adj_matrix = torch.zeros((num_nodes, num_nodes))
-    adj_matrix[edge_index[0], edge_index[1]] = 1
-    return adj_matrix
+# Create sparse CSR 0/1 adjacency matrix from edge_index
+def adjacency_matrix(edge_index, num_nodes):
+    values = torch.ones(edge_index.size(1), device=edge_index.device)
+    # edge_index comes from the caller, so check it: an out-of-range id raises here instead of corrupting memory later
+    g = torch.sparse_coo_tensor(edge_index, values, (num_nodes, num_nodes), check_invariants=True).to_sparse_csr()
+    return torch.sparse_csr_tensor(g.crow_indices(), g.col_indices(), torch.ones_like(g.values()), g.shape, check_invariants=False)  # Duplicate edges collapse to 1
 
 # Normalize the graph
 def norm_g(g):
-    return g / (g.sum(1, keepdim=True) + 1e-8)
+    if g.layout == torch.strided:
+        return g / (g.sum(1, keepdim=True) + 1e-8)
+    # Scale the stored values by the inverse row sums of a CSR matrix, no dense matrix is formed
+    g = g.to_sparse_csr()
+    crow_indices, col_indices, values = g.crow_indices(), g.col_indices(), g.values()
+    row_nnz = crow_indices.diff()
+    rows = torch.repeat_interleave(torch.arange(g.shape[0], device=values.device), row_nnz)
+    inv_deg = 1.0 / (values.new_zeros(g.shape[0]).index_add_(0, rows, values) + 1e-8)
+    return torch.sparse_csr_tensor(crow_indices, col_indices, values * inv_deg[rows], g.shape, check_invariants=False)
 
 def calculate_confidence_interval(data, confidence=0.95):
     """
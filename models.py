@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import GINConv,TopKPooling, global_max_pool, global_mean_pool
-import networkx as nx
 from methods import *
 
 
@@ -16,27 +15,54 @@ def make_convolution(in_channels, out_channels):
         nn.ReLU()
     ))
 
+# Fold final_proj(cat([feature_proj(Z), structure_proj(C)])) into the weight and bias of one linear map
+def fold_projections(feature_weight, feature_bias, structure_weight, structure_bias, final_weight, final_bias):
+    weight = torch.cat([final_weight[:, :1] * feature_weight, final_weight[:, 1:] * structure_weight], dim=1)
+    bias = final_weight[:, 0] * feature_bias + final_weight[:, 1] * structure_bias + final_bias
+    return weight, bias
+
+# Checkpoints saved before the projections were fused store them separately, fold them into proj on load
+def fold_checkpoint_projections(state_dict, prefix):
+    if prefix + 'feature_proj.weight' in state_dict:
+        names = ['feature_proj.weight', 'feature_proj.bias', 'structure_proj.weight',
+                 'structure_proj.bias', 'final_proj.weight', 'final_proj.bias']
+        weight, bias = fold_projections(*[state_dict.pop(prefix + name) for name in names])
+        state_dict[prefix + 'proj.weight'] = weight
+        state_dict[prefix + 'proj.bias'] = bias
+
+def make_score_projection(in_dim, structure_dim):
+    # Start from the composition of the three default-initialized projections it replaces
+    feature_proj, structure_proj, final_proj = nn.Linear(in_dim, 1), nn.Linear(structure_dim, 1), nn.Linear(2, 1)
+    proj = nn.Linear(in_dim + structure_dim, 1)
+    with torch.no_grad():
+        weight, bias = fold_projections(feature_proj.weight, feature_proj.bias, structure_proj.weight,
+                                        structure_proj.bias, final_proj.weight, final_proj.bias)
+        proj.weight.copy_(weight)
+        proj.bias.copy_(bias)
+    return proj
+
 # Define a pooling layer for centrality features
 class CentPool(nn.Module):
     def __init__(self, in_dim, ratio, p):
         super(CentPool, self).__init__()
         self.ratio = ratio
         self.cent_num = 6
-        self.sigmoid = nn.Sigmoid()
-        self.feature_proj = nn.Linear(in_dim, 1)
-        self.structure_proj = nn.Linear(self.cent_num, 1)
-        self.final_proj = nn.Linear(2, 1)
+        self.proj = make_score_projection(in_dim, self.cent_num)
         self.drop = nn.Dropout(p=p) if p > 0 else nn.Identity()
 
-    def forward(self, edge_index, h):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fold_checkpoint_projections(state_dict, prefix)
+        super(CentPool, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Dense scoring chain, compiled into fused kernels; node counts vary per batch so shapes stay dynamic
+    @torch.compile(dynamic=True)
+    def score(self, h, C):
         Z = self.drop(h)
-        G = edge_index_to_nx_graph(edge_index, h.shape[0])
-        C = all_centralities(G)
-        feature_weights = self.feature_proj(Z)
-        structure_weights = self.structure_proj(C)
-        weights = self.final_proj(torch.cat([feature_weights, structure_weights], dim=1)).squeeze()  # Combine and project weights
-        scores = self.sigmoid(weights)
-        g, h, idx = top_k_pool(scores, edge_index, h, self.ratio)
+        return self.proj(torch.cat([Z, C.to(Z.dtype)], dim=1)).squeeze()  # Project features and structure in one linear map
+
+    def forward(self, edge_index, h, C, hop3_index=None):
+        weights = self.score(h, C)
+        g, h, idx = top_k_pool(weights, edge_index, h, self.ratio, hop3_index)
         edge_index = edge_index[:, idx]
         return g, h, idx, edge_index
     
@@ -46,44 +72,40 @@ class SpectPool(nn.Module):
         super(SpectPool, self).__init__()
         self.ratio = ratio
         self.eigs_num = 3
-        self.sigmoid = nn.Sigmoid()
-        self.feature_proj = nn.Linear(in_dim, 1)
-        self.structure_proj = nn.Linear(self.eigs_num, 1)
-        self.final_proj = nn.Linear(2, 1)
+        self.proj = make_score_projection(in_dim, self.eigs_num)
         self.drop = nn.Dropout(p=p) if p > 0 else nn.Identity()
 
-    def forward(self, edge_index, h):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fold_checkpoint_projections(state_dict, prefix)
+        super(SpectPool, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Dense scoring chain, compiled into fused kernels; node counts vary per batch so shapes stay dynamic
+    @torch.compile(dynamic=True)
+    def score(self, h, L_a):
         Z = self.drop(h)
-        G = edge_index_to_nx_graph(edge_index, h.shape[0])
-        L = normalized_laplacian(G)
-        L_a = approximate_matrix(L, self.eigs_num)
-        feature_weights = self.feature_proj(Z)
-        structure_weights = self.structure_proj(L_a)
-        weights = self.final_proj(torch.cat([feature_weights, structure_weights], dim=1)).squeeze()  # Combine and project weights
-        scores = self.sigmoid(weights)
-        g, h, idx = top_k_pool(scores, edge_index, h, self.ratio)
+        return self.proj(torch.cat([Z, L_a.to(Z.dtype)], dim=1)).squeeze()  # Project features and eigenvectors in one linear map
+
+    def forward(self, edge_index, h, L_a, hop3_index=None):
+        weights = self.score(h, L_a)
+        g, h, idx = top_k_pool(weights, edge_index, h, self.ratio, hop3_index)
         edge_index = edge_index[:, idx]
         return g, h, idx, edge_index
 
 
 class SimpleUnpool(nn.Module):
     def forward(self, g, h, idx):
-        new_h = h.new_zeros([g.shape[0], h.shape[1]])
-        new_h[idx] = h
-        return new_h
+        # A fresh tensor per call, a reused module buffer would alias outputs that autograd or callers still hold
+        return h.new_zeros([g.shape[0], h.shape[1]]).index_copy_(0, idx, h)
 
 class Unpool(nn.Module):
     def forward(self, g, h, idx):
         new_h = h.new_zeros([g.shape[0], h.shape[1]])
-        new_h[idx] = h
-        idx_prime = torch.tensor([index for index in idx if index not in range(g.shape[0])])
-        
-        for i in idx_prime:
-            normalized_idx = idx.float() / g[i].sum()  # Normalize indices
-            weighted_mean = torch.sum(g[i][i] * normalized_idx)  # Compute weighted mean
-            new_h[i] = weighted_mean * h
-       
-        return new_h
+        new_h = new_h.index_copy(0, idx, h)  # Scatter pooled rows back in one kernel
+        # Dropped nodes take the degree-normalized sum of their restored neighbours, in one (sparse) matmul
+        g = g.to(h.dtype)
+        deg = (g @ h.new_ones([g.shape[0], 1])).clamp_min(1e-8)
+        dropped = torch.ones(g.shape[0], dtype=torch.bool, device=h.device).index_fill_(0, idx, False)
+        return torch.where(dropped.unsqueeze(-1), (g @ new_h) / deg, new_h)
     
 #Creating model that uses centralities
 class GIUNetSpect(nn.Module):
@@ -109,10 +131,10 @@ class GIUNetSpect(nn.Module):
 
         # Encoder
         x1 = F.relu(self.conv1(x, edge_index))
-        g1, x1_pooled, idx1, edge_index1 = self.pool1(edge_index, x1)
+        g1, x1_pooled, idx1, edge_index1 = self.pool1(edge_index, x1, data.leig, data.hop3_index)
 
         x2 = F.relu(self.conv2(x1_pooled, edge_index1))
-        _, x2_pooled, idx2, edge_index2 = self.pool2(edge_index1, x2)
+        _, x2_pooled, idx2, edge_index2 = self.pool2(edge_index1, x2, data.leig[idx1])  # Eigenvectors of the input graph, restricted to the kept nodes
 
         # Middle Convolution
         x_m = F.relu(self.midconv(x2_pooled, edge_index2))
@@ -121,7 +143,7 @@ class GIUNetSpect(nn.Module):
         x_d2 = self.unpool2(g1, x_m, idx2)
         x_d2 = F.relu(self.decoder2(x_d2, edge_index2))
 
-        x_d1 = self.unpool1(adjacency_matrix(edge_index), x_d2, idx1)
+        x_d1 = self.unpool1(adjacency_matrix(edge_index, num_nodes=x.size(0)), x_d2, idx1)
         x_d1 = F.relu(self.decoder1(x_d1))
 
         x_global_pool = global_mean_pool(x_d1, batch)
@@ -150,17 +172,17 @@ class GIUNetCent(nn.Module):
         x, edge_index, batch = data.x, data.edge_index, data.batch
         
         x1 = F.relu(self.conv1(x, edge_index))
-        g1, x1_pooled, idx1, edge_index1 = self.pool1(edge_index, x1)
+        g1, x1_pooled, idx1, edge_index1 = self.pool1(edge_index, x1, data.centralities, data.hop3_index)
         
         x2 = F.relu(self.conv2(x1_pooled, edge_index1))
-        _, x2_pooled, idx2, edge_index2 = self.pool2(edge_index1, x2)
+        _, x2_pooled, idx2, edge_index2 = self.pool2(edge_index1, x2, data.centralities[idx1])  # Centralities of the kept nodes
         
         x_m = F.relu(self.midconv(x2_pooled, edge_index2))
         
         x_d2 = self.unpool2(g1, x_m, idx2)
         x_d2 = F.relu(self.decoder2(x_d2, edge_index2))
         
-        x_d1 = self.unpool1(adjacency_matrix(edge_index), x_d2, idx1)
+        x_d1 = self.unpool1(adjacency_matrix(edge_index, num_nodes=x.size(0)), x_d2, idx1)
         x_d1 = F.relu(self.decoder1(x_d1))
 
         x_global_pool = global_mean_pool(x_d1, batch)
@@ -293,4 +315,7 @@ class GINModel(nn.Module):
 
         x_global_pool = global_mean_pool(x_final, batch)
 
-        return x_global_pool
\ No newline at end of file
+        return x_global_pool
+
+# Models whose pooling layers read the structural features precomputed with the dataset
+STRUCTURAL_FEATURE_MODELS = ['GIUNetSpect', 'GIUNetCent']
@@ -19,13 +19,15 @@ def create_model_results_directory(model_name):
         os.makedirs(model_results_dir)
     return model_results_dir
 
-def preprocess_dataset(dataset_name):
+def preprocess_dataset(dataset_name, structural_features=False):
     dataset_dir = os.path.join('datasets', dataset_name)
     if not os.path.exists(dataset_dir):
         os.makedirs(dataset_dir)
     dataset = TUDataset(root=dataset_dir, name=dataset_name)
     num_classes = dataset.num_classes
     num_features = dataset.num_features
+    if structural_features:
+        dataset = precompute_structural_features(dataset)  # Only the GIUNet pools read them, skip the cost for other models
     return dataset, num_features, num_classes
 
 def split_dataset(dataset, test_size=0.25):